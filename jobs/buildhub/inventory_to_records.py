@@ -13,14 +13,18 @@ import os
 import pkg_resources
 import re
 import sys
-from collections import defaultdict
 
 import aiohttp
 import backoff
 from decouple import config
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 from buildhub.utils import (
-    archive_url, chunked, is_release_build_metadata, is_build_url,
+    archive_url, is_release_build_metadata, is_build_url,
     record_from_url, localize_nightly_url, merge_metadata, check_record,
     localize_release_candidate_url, stream_as_generator, split_lines,
     ARCHIVE_URL, FILE_EXTENSIONS, DATETIME_FORMAT, ALL_PRODUCTS)
@@ -31,9 +35,24 @@ NB_RETRY_REQUEST = config('NB_RETRY_REQUEST', default=3, cast=int)
 TIMEOUT_SECONDS = config('TIMEOUT_SECONDS', default=5 * 60, cast=int)
 PRODUCTS = config(
     'PRODUCTS', default=' '.join(ALL_PRODUCTS),
-    cast=lambda v: [s.strip() for s in v.split()]
+    cast=lambda v: frozenset(s.strip() for s in v.split())
 )
 CACHE_FOLDER = config('CACHE_FOLDER', default='.')
+# All requests go to archive.mozilla.org, keep connections open for reuse.
+HTTP_LIMIT = config('HTTP_LIMIT', default=64, cast=int)
+HTTP_LIMIT_PER_HOST = config('HTTP_LIMIT_PER_HOST', default=64, cast=int)
+HTTP_KEEPALIVE_TIMEOUT = config('HTTP_KEEPALIVE_TIMEOUT', default=75, cast=int)
+DNS_CACHE_TTL = config('DNS_CACHE_TTL', default=300, cast=int)
+
+# Patterns used for every record, compiled once.
+_ARCHIVE_EXTENSION_RE = re.compile(
+    r'\.({})$'.format('|'.join(FILE_EXTENSIONS))
+)
+_REPACK_PLATFORM_RE = re.compile(r'-(eme-free|sha1)', flags=re.I)
+_OLD_NIGHTLY_METADATA_RE = re.compile(r'^(\d+)\n(http.+)/rev/(.+)$')
+_VERY_OLD_NIGHTLY_METADATA_RE = re.compile(r'^(\d+) (.+)$')
+_BUILD_NUMBER_RE = re.compile(r'/build(\d+)/')
+_NON_DIGITS_RE = re.compile('[^0-9]')
 
 logger = logging.getLogger()  # root logger.
 
@@ -45,6 +64,29 @@ class JSONFileNotFound(Exception):
     """Happens when we try to fetch a JSON URL and the response is a 404"""
 
 
+# Listings of archive.mozilla.org can be large, parse them with orjson.
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+_JSON_HEADERS = {
+    'Accept': 'application/json',
+    'Cache': 'no-cache',
+    'User-Agent': 'BuildHub;storage-team@mozilla.com'
+}
+
+
+def create_session(loop):
+    """Return a HTTP session tuned for many requests to archive.mozilla.org.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        loop=loop
+    )
+    return aiohttp.ClientSession(loop=loop, connector=connector)
+
+
 async def read_csv(input_generator):
     """
     :param input_generator: async generator of raw bytes
@@ -78,17 +120,12 @@ async def fetch_json(
     archive.mozilla.org so if you just back off and try again
     in a couple of seconds it will work.
     """
-    headers = {
-        'Accept': 'application/json',
-        'Cache': 'no-cache',
-        'User-Agent': 'BuildHub;storage-team@mozilla.com'
-    }
     try:
         with async_timeout.timeout(timeout):
             logger.debug("GET '{}'".format(url))
             async with session.get(
                 url,
-                headers=headers,
+                headers=_JSON_HEADERS,
                 timeout=None
             ) as response:
                 if response.status == 404 and not retry_on_notfound:
@@ -96,10 +133,11 @@ async def fetch_json(
 
                 response.raise_for_status()
                 try:
-                    return await response.json()
+                    return await response.json(loads=_json_loads)
                 except aiohttp.ClientResponseError as e:
                     # Some JSON files are served with wrong content-type.
                     return await response.json(
+                        loads=_json_loads,
                         content_type='application/octet-stream'
                     )
     except asyncio.TimeoutError:
@@ -115,11 +153,48 @@ async def fetch_listing(session, url):
         raise ValueError("Could not fetch '{}': {}".format(url, e))
 
 
+_metadata_fetches = {}
+
+
+def _metadata_key(record):
+    """Return the key of the metadata shared by several records, e.g.
+    every locale of a nightly build.
+    """
+    url = record['download']['url']
+    if 'nightly' in record['target']['channel']:
+        return localize_nightly_url(url)
+    if 'rc' in record['target']['version']:
+        return localize_release_candidate_url(url)
+    # Metadata for EME-free and sha1 repacks are the same as original release.
+    platform = _REPACK_PLATFORM_RE.sub('', record['target']['platform'])
+    return (record['source']['product'], record['target']['version'], platform)
+
+
 async def fetch_metadata(session, record):
+    # Concurrent callers share the fetch in progress for the same metadata.
+    key = _metadata_key(record)
+    if key not in _metadata_fetches:
+        _metadata_fetches[key] = asyncio.ensure_future(
+            _fetch_metadata(session, record))
     try:
-        if 'nightly' in record['target']['channel']:  # nightly-old-id
+        return await _metadata_fetches[key]
+    finally:
+        _metadata_fetches.pop(key, None)
+
+
+async def _fetch_metadata(session, record):
+    is_nightly = 'nightly' in record['target']['channel']  # nightly-old-id
+    is_rc = 'rc' in record['target']['version']
+    if not is_nightly and not is_rc:
+        # Scan the list of candidates metadata (no-op if already
+        # initialized). Only releases need it, nightly and RC metadata are
+        # found from the archive URL.
+        # Failures are not a missing metadata, let them propagate.
+        await scan_candidates(session, record['source']['product'])
+    try:
+        if is_nightly:
             return await fetch_nightly_metadata(session, record)
-        if 'rc' in record['target']['version']:
+        if is_rc:
             return await fetch_release_candidate_metadata(session, record)
         return await fetch_release_metadata(session, record)
     except ValueError as e:
@@ -146,14 +221,8 @@ async def fetch_nightly_metadata(session, record):
     if nightly_url in _nightly_metadata:
         return _nightly_metadata[nightly_url]
 
-    extensions = '|'.join(FILE_EXTENSIONS)
-
     try:
-        metadata_url = re.sub(
-            '\.({})$'.format(extensions),
-            '.json',
-            nightly_url
-        )
+        metadata_url = _ARCHIVE_EXTENSION_RE.sub('.json', nightly_url)
         metadata = await fetch_json(session, metadata_url)
         _nightly_metadata[nightly_url] = metadata
         return metadata
@@ -163,14 +232,10 @@ async def fetch_nightly_metadata(session, record):
         try:
             # e.g. https://archive.mozilla.org/pub/firefox/nightly/2011/05/
             #      2011-05-05-03-mozilla-central/firefox-6.0a1.en-US.mac.txt
-            old_metadata_url = re.sub(
-                '\.({})$'.format(extensions),
-                '.txt',
-                nightly_url
-            )
+            old_metadata_url = _ARCHIVE_EXTENSION_RE.sub('.txt', nightly_url)
             async with session.get(old_metadata_url) as response:
                 old_metadata = await response.text()
-                m = re.search('^(\d+)\n(http.+)/rev/(.+)$', old_metadata)
+                m = _OLD_NIGHTLY_METADATA_RE.search(old_metadata)
                 if m:
                     metadata = {
                         'buildid': m.group(1),
@@ -181,7 +246,7 @@ async def fetch_nightly_metadata(session, record):
                     return metadata
                 # e.g.
                 # https://archive.mozilla.org/pub/firefox/nightly/2010/07/2010-07-04-05-mozilla-central/firefox-4.0b2pre.en-US.win64-x86_64.txt
-                m = re.search('^(\d+) (.+)$', old_metadata)
+                m = _VERY_OLD_NIGHTLY_METADATA_RE.search(old_metadata)
                 if m:
                     metadata = {
                         'buildid': m.group(1),
@@ -199,7 +264,7 @@ async def fetch_nightly_metadata(session, record):
             f"Could not fetch metadata for '{record['id']}' "
             f"from '{metadata_url}'"
         )
-        _nightly_metadata[url] = None  # Don't try it anymore.
+        _nightly_metadata[nightly_url] = None  # Don't try it anymore.
         return None
 
 
@@ -224,11 +289,7 @@ async def fetch_release_candidate_metadata(session, record):
     if product == 'devedition':
         product = 'firefox'
     if product == 'fennec':
-        metadata_url = re.sub(
-            '\.({})$'.format('|'.join(FILE_EXTENSIONS)),
-            '.json',
-            rc_url
-        )
+        metadata_url = _ARCHIVE_EXTENSION_RE.sub('.json', rc_url)
     else:
         major_version = record['target']['version'].split('rc')[0]
         parts = rc_url.split('/')
@@ -246,14 +307,15 @@ async def fetch_release_candidate_metadata(session, record):
         _rc_metadata[rc_url] = None  # Don't try it anymore.
         return None
 
-    m = re.search('/build(\d+)/', url)
+    m = _BUILD_NUMBER_RE.search(url)
     metadata['buildnumber'] = int(m.group(1))
 
     _rc_metadata[rc_url] = metadata
     return metadata
 
 
-_candidates_build_folder = defaultdict(dict)
+_candidates_build_folder = {}
+_candidates_scans = {}
 
 
 async def scan_candidates(session, product):
@@ -266,31 +328,57 @@ async def scan_candidates(session, product):
     if product in _candidates_build_folder:
         return
 
+    # Concurrent callers share the scan in progress for this product.
+    if product not in _candidates_scans:
+        _candidates_scans[product] = asyncio.ensure_future(
+            _scan_candidates(session, product)
+        )
+    try:
+        latest_build_folders = await _candidates_scans[product]
+    finally:
+        _candidates_scans.pop(product, None)
+
+    # Only expose the result once the scan is complete.
+    _candidates_build_folder[product] = latest_build_folders
+
+
+async def _scan_candidates(session, product):
     logger.info(
         f"Scan '{product}' candidates to get their latest build folder..."
     )
+    latest_build_folders = {}
     candidates_url = archive_url(product, candidate='/')
     candidates_folders, _ = await fetch_listing(session, candidates_url)
 
-    for chunk in chunked(candidates_folders, NB_PARALLEL_REQUESTS):
-        futures = []
-        versions = []
-        for folder in chunk:
-            if '-candidates' not in folder:
-                continue
-            version = folder.replace('-candidates/', '')
-            versions.append(version)
+    # Keep NB_PARALLEL_REQUESTS listings in flight, without waiting for
+    # the slowest one of a chunk before starting the next ones.
+    semaphore = asyncio.Semaphore(NB_PARALLEL_REQUESTS)
+
+    async def fetch_builds_listing(version):
+        async with semaphore:
             builds_url = archive_url(product, version, candidate='/')
-            future = fetch_listing(session, builds_url)
-            futures.append(future)
-        listings = await asyncio.gather(*futures)
+            return await fetch_listing(session, builds_url)
+
+    versions = [
+        folder.replace('-candidates/', '')
+        for folder in candidates_folders
+        if '-candidates' in folder
+    ]
+    listings = await asyncio.gather(*[
+        fetch_builds_listing(version) for version in versions
+    ])
+
+    for version, (build_folders, _) in zip(versions, listings):
+        if not build_folders:
+            # No build yet for this version.
+            continue
+        latest_build_folder = max(
+            build_folders,
+            key=lambda x: _NON_DIGITS_RE.sub('', x).zfill(3)
+        )
+        latest_build_folders[version] = latest_build_folder
 
-        for version, (build_folders, _) in zip(versions, listings):
-            latest_build_folder = sorted(
-                build_folders,
-                key=lambda x: re.sub("[^0-9]", "", x).zfill(3)
-            )[-1]
-            _candidates_build_folder[product][version] = latest_build_folder
+    return latest_build_folders
 
 
 _release_metadata = {}
@@ -316,7 +404,7 @@ async def fetch_release_metadata(session, record):
     build_number = int(latest_build_folder.strip('/')[-1])  # build3 -> 3
 
     # Metadata for EME-free and sha1 repacks are the same as original release.
-    platform = re.sub('-(eme-free|sha1)', '', platform, flags=re.I)
+    platform = _REPACK_PLATFORM_RE.sub('', platform)
 
     url = archive_url(
         product, version, platform, locale, candidate='/' + latest_build_folder
@@ -433,7 +521,7 @@ async def csv_to_records(
         _release_metadata.update(metadata['release'])
         _nightly_metadata.update(metadata['nightly'])
 
-    async with aiohttp.ClientSession(loop=loop) as session:
+    async with create_session(loop) as session:
         batch = []
 
         async for entries in inventory_by_folder(stdin):
@@ -451,10 +539,6 @@ async def csv_to_records(
                 if product not in PRODUCTS:
                     continue
 
-                # Scan the list of candidates metadata (no-op if
-                # already initialized).
-                await scan_candidates(session, product)
-
                 url = ARCHIVE_URL + object_key.replace('+', ' ')
 
                 if not is_build_url(product, url):
@@ -478,9 +562,9 @@ async def csv_to_records(
                 record['download']['size'] = filesize
                 record['download']['date'] = lastmodified
 
-                if len(batch) < NB_PARALLEL_REQUESTS:
-                    batch.append(record)
-                else:
+                # Metadata of a full batch is fetched concurrently.
+                batch.append(record)
+                if len(batch) >= NB_PARALLEL_REQUESTS:
                     async for result in process_batch(
                         session,
                         batch,
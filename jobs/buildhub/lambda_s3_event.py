@@ -3,40 +3,307 @@
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
 import asyncio
+import concurrent.futures
 import datetime
 import json
 import logging
 import re
 import sys
 
-import aiohttp
 import kinto_http
 from decouple import config
 from raven.contrib.awslambda import LambdaClient
 
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
+
 from buildhub import utils
 from buildhub.inventory_to_records import (
     NB_RETRY_REQUEST,
+    create_session,
     fetch_json,
     fetch_listing,
-    fetch_metadata,
-    scan_candidates
+    fetch_metadata
 )
 from buildhub.configure_markus import get_metrics
 
 
+NB_THREADS = config('NB_THREADS', default=3, cast=int)
+MAX_CONCURRENCY = config('MAX_CONCURRENCY', default=16, cast=int)
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+
 # Optional Sentry with synchronuous client.
 SENTRY_DSN = config('SENTRY_DSN', default=None)
 sentry = LambdaClient(SENTRY_DSN)
 
 logger = logging.getLogger()  # root logger.
+_log_handler = logging.StreamHandler(stream=sys.stdout)
 metrics = get_metrics('buildhub')
 
+# Event loop and HTTP session reused across the invocations of a warm
+# lambda container.
+_loop = None
+_session = None
+
+# Patterns applied to every event URL.
+_BUILD_NUM_RE = re.compile(r'/build(\d+)/')
+_MULTI_RE = re.compile(r'multi/.+$')
+_ENUS_RE = re.compile(r'en-US/.+$')
+_LAST_SEGMENT_RE = re.compile(r'/[^/]+$')
+_L10N_RE = re.compile(r'-mozilla-central([^/]*)/([^/]+)$')
+# S3 event time, e.g. 2017-08-08T17:06:52.030Z
+_EVENT_TIME_RE = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,6}Z$')
+
 
-async def main(loop, event):
+@metrics.timer_decorator('s3_event_records_to_create')
+def _publish(client, records, bucket, collection):
+    """Synchronuous function that creates the records on Kinto in batch.
+    """
+    with client.batch() as batch:
+        for record in records:
+            # Check that fields values look OK.
+            utils.check_record(record)
+            batch.create_record(data=record,
+                                bucket=bucket,
+                                collection=collection,
+                                if_not_exists=True)
+    results = batch.results()
+
+    # Batch don't fail with 4XX errors. Make sure we output a comprehensive
+    # error here when we encounter them.
+    error_msgs = []
+    for record, result in zip(records, results):
+        error_status = result.get('code')
+        if error_status == 412:
+            logger.info('Exists {}'.format(record['id']))
+        elif error_status == 400:
+            error_msg = 'Invalid record: {}'.format(result)
+            error_msgs.append(error_msg)
+        elif error_status is not None:
+            error_msgs.append('Error: {}'.format(result))
+        else:
+            logger.info('Created {}'.format(record['id']))
+            metrics.incr('s3_event_record_created')
+    if error_msgs:
+        raise ValueError('\n'.join(error_msgs))
+
+    return results
+
+
+def _format_event_time(event_time):
+    """Convert the S3 event time to ``utils.DATETIME_FORMAT``.
+    """
+    if _EVENT_TIME_RE.match(event_time):
+        # Same as parsing it and formatting it without the microseconds.
+        return event_time[:19] + 'Z'
+    return datetime.datetime.strptime(
+        event_time,
+        '%Y-%m-%dT%H:%M:%S.%fZ'
+    ).strftime(utils.DATETIME_FORMAT)
+
+
+async def _fetch_listing_or_empty(session, url):
+    try:
+        return await fetch_listing(session, url)
+    except ValueError:
+        return [], []  # e.g. No -l10n/ folder published yet.
+
+
+async def records_from_event(session, event_record):
+    """Return the list of records to create for the specified S3 event.
+    """
+    metrics.incr('s3_event_event')
+    records_to_create = []
+
+    # Use event time as archive publication.
+    event_time = _format_event_time(event_record['eventTime'])
+
+    key = event_record['s3']['object']['key']
+    filesize = event_record['s3']['object']['size']
+    url = utils.ARCHIVE_URL + key
+    logger.debug("Event file {}".format(url))
+
+    try:
+        product = key.split('/', 2)[1]  # /pub/thunderbird/nightly/...
+    except IndexError:
+        return []  # e.g. https://archive.mozilla.org/favicon.ico
+
+    if product not in utils.ALL_PRODUCTS:
+        logger.info('Skip product {}'.format(product))
+        return []
+
+    # Release / Nightly / RC archive.
+    if utils.is_build_url(product, url):
+        logger.info('Processing {} archive: {}'.format(product, key))
+
+        record = utils.record_from_url(url)
+        # Use S3 event infos for the archive.
+        record['download']['size'] = filesize
+        record['download']['date'] = event_time
+
+        # Fetch release metadata.
+        logger.debug("Fetch record metadata")
+        metadata = await fetch_metadata(session, record)
+        # If JSON metadata not available, archive will be
+        # handled when JSON is delivered.
+        if metadata is None:
+            logger.info(
+                f"JSON metadata not available {record['id']}"
+            )
+            return []
+
+        # Merge obtained metadata.
+        record = utils.merge_metadata(record, metadata)
+        records_to_create.append(record)
+
+    # RC metadata
+    elif utils.is_rc_build_metadata(product, url):
+        logger.info(f'Processing {product} RC metadata: {key}')
+
+        # pub/firefox/candidates/55.0b12-candidates/build1/mac/en-US/
+        # firefox-55.0b12.json
+        logger.debug("Fetch new metadata")
+        # It has been known to happen that right after an S3 Event
+        # there's a slight delay to the metadata json file being
+        # available. If that's the case we want to retry in a couple
+        # of seconds to see if it's available on the next backoff
+        # attempt.
+        metadata = await fetch_json(
+            session,
+            url,
+            retry_on_notfound=True
+        )
+        metadata['buildnumber'] = int(
+            _BUILD_NUM_RE.search(url).group(1)
+        )
+
+        # We just received the metadata file. Lookup if the associated
+        # archives are here too.
+        archives = []
+        if 'multi' in url:
+            # For multi we just check the associated archive
+            # is here already.
+            parent_folder = _MULTI_RE.sub('multi/', url)
+            _, files = await fetch_listing(session, parent_folder)
+            for f in files:
+                rc_url = parent_folder + f['name']
+                if utils.is_build_url(product, rc_url):
+                    archives.append((
+                        rc_url,
+                        f['size'],
+                        f['last_modified']
+                    ))
+        else:
+            # For en-US it's different, it applies to every
+            # localized archives.
+            # Check if they are here by listing the parent folder
+            # (including en-US archive).
+            l10n_parent_url = _ENUS_RE.sub('', url)
+            l10n_folders, _ = await fetch_listing(
+                session,
+                l10n_parent_url
+            )
+            # Fetch the listing of every locale in parallel.
+            listings = await asyncio.gather(*[
+                fetch_listing(session, l10n_parent_url + locale)
+                for locale in l10n_folders
+            ])
+            for locale, (_, files) in zip(l10n_folders, listings):
+                for f in files:
+                    rc_url = l10n_parent_url + locale + f['name']
+                    if utils.is_build_url(product, rc_url):
+                        archives.append((
+                            rc_url,
+                            f['size'],
+                            f['last_modified'],
+                        ))
+
+        for rc_url, size, last_modified in archives:
+            record = utils.record_from_url(rc_url)
+            record['download']['size'] = size
+            record['download']['date'] = last_modified
+            record = utils.merge_metadata(record, metadata)
+            records_to_create.append(record)
+        # Theorically release should never be there yet :)
+        # And repacks like EME-free/sha1 don't seem to be
+        # published in RC.
+
+    # Nightly metadata
+    # pub/firefox/nightly/2017/08/2017-08-08-11-40-32-mozilla-central/
+    # firefox-57.0a1.en-US.linux-i686.json
+    # -l10n/...
+    elif utils.is_nightly_build_metadata(product, url):
+        logger.info(
+            f'Processing {product} nightly metadata: {key}'
+        )
+
+        logger.debug("Fetch new nightly metadata")
+        # See comment above about the exceptional need of
+        # setting retry_on_notfound here.
+        metadata = await fetch_json(
+            session,
+            url,
+            retry_on_notfound=True
+        )
+
+        platform = metadata['moz_pkg_platform']
+
+        # Check if english version is here, and also localized versions.
+        parent_url = _LAST_SEGMENT_RE.sub('/', url)
+        l10n_folder_url = _L10N_RE.sub('-mozilla-central\\1-l10n/', url)
+        logger.debug("Fetch parent listing {}".format(parent_url))
+        logger.debug("Fetch l10n listing {}".format(l10n_folder_url))
+        (_, files), (_, l10n_files) = await asyncio.gather(
+            fetch_listing(session, parent_url),
+            _fetch_listing_or_empty(session, l10n_folder_url)
+        )
+        for f in files:
+            if ('.' + platform + '.') not in f['name']:
+                # metadata are by platform.
+                continue
+            en_nightly_url = parent_url + f['name']
+            if utils.is_build_url(product, en_nightly_url):
+                record = utils.record_from_url(en_nightly_url)
+                record['download']['size'] = f['size']
+                record['download']['date'] = f['last_modified']
+                record = utils.merge_metadata(record, metadata)
+                records_to_create.append(record)
+                break  # Only one file for english.
+
+        for f in l10n_files:
+            if (
+                ('.' + platform + '.') not in f['name'] and
+                product != 'mobile'
+            ):
+                # metadata are by platform.
+                # (mobile platforms are contained by folder)
+                continue
+            nightly_url = l10n_folder_url + f['name']
+            if utils.is_build_url(product, nightly_url):
+                record = utils.record_from_url(nightly_url)
+                record['download']['size'] = f['size']
+                record['download']['date'] = f['last_modified']
+                record = utils.merge_metadata(record, metadata)
+                records_to_create.append(record)
+
+    else:
+        logger.info('Ignored {}'.format(key))
+
+    logger.debug(
+        f"{len(records_to_create)} records to create."
+    )
+    return records_to_create
+
+
+async def main(loop, event, session=None):
     """
     Trigger when S3 event kicks in.
     http://docs.aws.amazon.com/AmazonS3/latest/dev/notification-content-structure.html
+
+    If no HTTP ``session`` is specified, one is created for this event
+    and closed once done.
     """
     server_url = config('SERVER_URL', default='http://localhost:8888/v1')
     bucket = config('BUCKET', default='build-hub')
@@ -53,222 +320,77 @@ async def main(loop, event):
         else:
             records.append(record)
 
-    async with aiohttp.ClientSession(loop=loop) as session:
-        for event_record in records:
-            metrics.incr('s3_event_event')
-            records_to_create = []
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=NB_THREADS)
+    # Limit the number of events processed concurrently.
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY, loop=loop)
+
+    owns_session = session is None
+    if owns_session:
+        session = create_session(loop)
 
-            # Use event time as archive publication.
-            event_time = datetime.datetime.strptime(
-                event_record['eventTime'],
-                '%Y-%m-%dT%H:%M:%S.%fZ'
+    async def handle(event_record):
+        async with semaphore:
+            records_to_create = await records_from_event(
+                session,
+                event_record
+            )
+        if records_to_create:
+            # Publish in a thread while other events are processed.
+            await loop.run_in_executor(
+                executor,
+                _publish,
+                kinto_client,
+                records_to_create,
+                bucket,
+                collection
             )
-            event_time = event_time.strftime(utils.DATETIME_FORMAT)
 
-            key = event_record['s3']['object']['key']
-            filesize = event_record['s3']['object']['size']
-            url = utils.ARCHIVE_URL + key
-            logger.debug("Event file {}".format(url))
+    tasks = [asyncio.ensure_future(handle(r), loop=loop) for r in records]
+    try:
+        await asyncio.gather(*tasks, loop=loop)
+    except Exception:
+        # Don't leave the other events running once the session
+        # is closed.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, loop=loop, return_exceptions=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        if owns_session:
+            await session.close()
 
-            try:
-                product = key.split('/')[1]  # /pub/thunderbird/nightly/...
-            except IndexError:
-                continue  # e.g. https://archive.mozilla.org/favicon.ico
 
-            if product not in utils.ALL_PRODUCTS:
-                logger.info('Skip product {}'.format(product))
-                continue
+def _get_event_loop():
+    global _loop
+    if _loop is None or _loop.is_closed():
+        if uvloop is not None:
+            _loop = uvloop.new_event_loop()
+        else:
+            _loop = asyncio.get_event_loop_policy().new_event_loop()
+    return _loop
 
-            # Release / Nightly / RC archive.
-            if utils.is_build_url(product, url):
-                logger.info('Processing {} archive: {}'.format(product, key))
-
-                record = utils.record_from_url(url)
-                # Use S3 event infos for the archive.
-                record['download']['size'] = filesize
-                record['download']['date'] = event_time
-
-                # Fetch release metadata.
-                await scan_candidates(session, product)
-                logger.debug("Fetch record metadata")
-                # metadata = await fetch_metadata(session, record)
-                metadata = await fetch_metadata(session, record)
-                # If JSON metadata not available, archive will be
-                # handled when JSON is delivered.
-                if metadata is None:
-                    logger.info(
-                        f"JSON metadata not available {record['id']}"
-                    )
-                    continue
-
-                # Merge obtained metadata.
-                record = utils.merge_metadata(record, metadata)
-                records_to_create.append(record)
 
-            # RC metadata
-            elif utils.is_rc_build_metadata(product, url):
-                logger.info(f'Processing {product} RC metadata: {key}')
-
-                # pub/firefox/candidates/55.0b12-candidates/build1/mac/en-US/
-                # firefox-55.0b12.json
-                logger.debug("Fetch new metadata")
-                # It has been known to happen that right after an S3 Event
-                # there's a slight delay to the metadata json file being
-                # available. If that's the case we want to retry in a couple
-                # of seconds to see if it's available on the next backoff
-                # attempt.
-                metadata = await fetch_json(
-                    session,
-                    url,
-                    retry_on_notfound=True
-                )
-                metadata['buildnumber'] = int(
-                    re.search('/build(\d+)/', url).group(1)
-                )
-
-                # We just received the metadata file. Lookup if the associated
-                # archives are here too.
-                archives = []
-                if 'multi' in url:
-                    # For multi we just check the associated archive
-                    # is here already.
-                    parent_folder = re.sub('multi/.+$', 'multi/', url)
-                    _, files = await fetch_listing(session, parent_folder)
-                    for f in files:
-                        rc_url = parent_folder + f['name']
-                        if utils.is_build_url(product, rc_url):
-                            archives.append((
-                                rc_url,
-                                f['size'],
-                                f['last_modified']
-                            ))
-                else:
-                    # For en-US it's different, it applies to every
-                    # localized archives.
-                    # Check if they are here by listing the parent folder
-                    # (including en-US archive).
-                    l10n_parent_url = re.sub('en-US/.+$', '', url)
-                    l10n_folders, _ = await fetch_listing(
-                        session,
-                        l10n_parent_url
-                    )
-                    for locale in l10n_folders:
-                        _, files = await fetch_listing(
-                            session,
-                            l10n_parent_url + locale
-                        )
-                        for f in files:
-                            rc_url = l10n_parent_url + locale + f['name']
-                            if utils.is_build_url(product, rc_url):
-                                archives.append((
-                                    rc_url,
-                                    f['size'],
-                                    f['last_modified'],
-                                ))
-
-                for rc_url, size, last_modified in archives:
-                    record = utils.record_from_url(rc_url)
-                    record['download']['size'] = size
-                    record['download']['date'] = last_modified
-                    record = utils.merge_metadata(record, metadata)
-                    records_to_create.append(record)
-                # Theorically release should never be there yet :)
-                # And repacks like EME-free/sha1 don't seem to be
-                # published in RC.
-
-            # Nightly metadata
-            # pub/firefox/nightly/2017/08/2017-08-08-11-40-32-mozilla-central/
-            # firefox-57.0a1.en-US.linux-i686.json
-            # -l10n/...
-            elif utils.is_nightly_build_metadata(product, url):
-                logger.info(
-                    f'Processing {product} nightly metadata: {key}'
-                )
-
-                logger.debug("Fetch new nightly metadata")
-                # See comment above about the exceptional need of
-                # setting retry_on_notfound here.
-                metadata = await fetch_json(
-                    session,
-                    url,
-                    retry_on_notfound=True
-                )
-
-                platform = metadata['moz_pkg_platform']
-
-                # Check if english version is here.
-                parent_url = re.sub('/[^/]+$', '/', url)
-                logger.debug("Fetch parent listing {}".format(parent_url))
-                _, files = await fetch_listing(session, parent_url)
-                for f in files:
-                    if ('.' + platform + '.') not in f['name']:
-                        # metadata are by platform.
-                        continue
-                    en_nightly_url = parent_url + f['name']
-                    if utils.is_build_url(product, en_nightly_url):
-                        record = utils.record_from_url(en_nightly_url)
-                        record['download']['size'] = f['size']
-                        record['download']['date'] = f['last_modified']
-                        record = utils.merge_metadata(record, metadata)
-                        records_to_create.append(record)
-                        break  # Only one file for english.
-
-                # Check also localized versions.
-                l10n_folder_url = re.sub('-mozilla-central([^/]*)/([^/]+)$',
-                                         '-mozilla-central\\1-l10n/',
-                                         url)
-                logger.debug("Fetch l10n listing {}".format(l10n_folder_url))
-                try:
-                    _, files = await fetch_listing(session, l10n_folder_url)
-                except ValueError:
-                    files = []  # No -l10/ folder published yet.
-                for f in files:
-                    if (
-                        ('.' + platform + '.') not in f['name'] and
-                        product != 'mobile'
-                    ):
-                        # metadata are by platform.
-                        # (mobile platforms are contained by folder)
-                        continue
-                    nightly_url = l10n_folder_url + f['name']
-                    if utils.is_build_url(product, nightly_url):
-                        record = utils.record_from_url(nightly_url)
-                        record['download']['size'] = f['size']
-                        record['download']['date'] = f['last_modified']
-                        record = utils.merge_metadata(record, metadata)
-                        records_to_create.append(record)
-
-            else:
-                logger.info('Ignored {}'.format(key))
-
-            logger.debug(
-                f"{len(records_to_create)} records to create."
-            )
-            with metrics.timer('s3_event_records_to_create'):
-                for record in records_to_create:
-                    # Check that fields values look OK.
-                    utils.check_record(record)
-                    # Push result to Kinto.
-                    kinto_client.create_record(data=record,
-                                               bucket=bucket,
-                                               collection=collection,
-                                               if_not_exists=True)
-                    logger.info('Created {}'.format(record['id']))
-                    metrics.incr('s3_event_record_created')
+def _get_session(loop):
+    global _session
+    if _session is None or _session.closed or _session.loop is not loop:
+        _session = create_session(loop)
+    return _session
 
 
 @sentry.capture_exceptions
 def lambda_handler(event, context):
-    # Log everything to stderr.
-    logger.addHandler(logging.StreamHandler(stream=sys.stdout))
-    logger.setLevel(logging.DEBUG)
+    # Log to stdout (no-op if already added by a previous invocation).
+    logger.addHandler(_log_handler)
+    logger.setLevel(LOG_LEVEL.upper())
 
-    loop = asyncio.get_event_loop_policy().new_event_loop()
+    # The loop is not closed, the next invocation will reuse it.
+    loop = _get_event_loop()
+    # Keep the connections to archive.mozilla.org open between events.
+    session = _get_session(loop)
 
     try:
-        loop.run_until_complete(main(loop, event))
+        loop.run_until_complete(main(loop, event, session=session))
     except Exception:
         logger.exception('Aborted.')
         raise
-    finally:
-        loop.close()
@@ -22,9 +22,7 @@ It is meant to be combined with other commands that output records to stdout :)
 
 """
 import asyncio
-import async_timeout
 import concurrent.futures
-import copy
 import hashlib
 import json
 import logging
@@ -35,6 +33,11 @@ from urllib.parse import urlparse
 from kinto_http import cli_utils
 from decouple import config
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 from buildhub.utils import stream_as_generator
 from buildhub.configure_markus import get_metrics
 
@@ -42,13 +45,16 @@ from buildhub.configure_markus import get_metrics
 DEFAULT_SERVER = 'http://localhost:8888/v1'
 DEFAULT_BUCKET = 'default'
 DEFAULT_COLLECTION = 'cid'
-NB_THREADS = 3
+# Publishing is I/O bound (HTTP batches to the Kinto server), more threads
+# means more batches in flight.
+NB_THREADS = config('NB_THREADS', default=16, cast=int)
 NB_RETRY_REQUEST = 3
-WAIT_TIMEOUT = 5
 BATCH_MAX_REQUESTS = config('BATCH_MAX_REQUESTS', default=9999, cast=int)
 OLD_PREVIOUS_DUMP_FILENAME = '.records-{server}-{bucket}-{collection}.json'
 PREVIOUS_DUMP_FILENAME = '.records-hashes-{server}-{bucket}-{collection}.json'
 CACHE_FOLDER = config('CACHE_FOLDER', default='.')
+# Fields set by the server, that are not part of the record content.
+HASH_OMITTED_FIELDS = ('last_modified', 'schema')
 
 logger = logging.getLogger(__name__)
 metrics = get_metrics('buildhub')
@@ -56,6 +62,26 @@ metrics = get_metrics('buildhub')
 done = object()
 
 
+def _load_json_file(filename):
+    if orjson is not None:
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _dump_json_file(data, filename):
+    if orjson is not None:
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(
+                data,
+                option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2
+            ))
+        return
+    with open(filename, 'w') as f:
+        json.dump(data, f, sort_keys=True, indent=2)
+
+
 def _migrate_old_dump_file(old_file, new_file):
     """The old file is a .json file that, when opened, is a massive list of
     dictionaries. Open it and save to the new JSON file.
@@ -66,8 +92,7 @@ def _migrate_old_dump_file(old_file, new_file):
 
     E.g.
     """
-    with open(old_file) as f:
-        data = json.load(f)
+    data = _load_json_file(old_file)
 
     new_data = {}
     for record in data:
@@ -76,17 +101,18 @@ def _migrate_old_dump_file(old_file, new_file):
             _hash_record_mutate(record)
         ]
 
-    with open(new_file, 'w') as f:
-        json.dump(new_data, f, sort_keys=True, indent=2)
+    _dump_json_file(new_data, new_file)
 
 
 def hash_record(record):
     """Return a hash string (based of MD5) that is 32 characters long.
 
-    This function does *not mutate* the record but needs to make a copy of
-    the record (and mutate that) so it's less performant.
+    This function does *not mutate* the record. Only top-level fields are
+    omitted from the hash, so a shallow copy is enough.
     """
-    return _hash_record_mutate(copy.deepcopy(record))
+    return _hash_record_mutate({
+        k: v for k, v in record.items() if k not in HASH_OMITTED_FIELDS
+    })
 
 
 def _hash_record_mutate(record):
@@ -96,8 +122,8 @@ def _hash_record_mutate(record):
     Yeah, that sucks but it's more performant than having to clone a copy
     when you have to do it 1 million of these records.
     """
-    record.pop('last_modified', None)
-    record.pop('schema', None)
+    for field in HASH_OMITTED_FIELDS:
+        record.pop(field, None)
     return hashlib.md5(
        json.dumps(record, sort_keys=True).encode('utf-8')
     ).hexdigest()
@@ -148,17 +174,18 @@ def fetch_existing(
     previous_run_etag = None
 
     if os.path.exists(cache_file):
-        with open(cache_file) as f:
-            records = json.load(f)
-            highest_timestamp = max(
-                [r[0] for r in records.values()]
-            )
+        records = _load_json_file(cache_file)
+        if records:
+            highest_timestamp = max(r[0] for r in records.values())
             previous_run_etag = '"%s"' % highest_timestamp
 
     new_records = client.get_records(
         _since=previous_run_etag,
         pages=float('inf')
     )
+    if not new_records:
+        # Nothing changed since the last run, the cache file is up-to-date.
+        return records
 
     for record in new_records:
         records[record['id']] = [
@@ -169,8 +196,7 @@ def fetch_existing(
     # Atomic write.
     if records:
         tmpfilename = cache_file + '.tmp'
-        with open(tmpfilename, 'w') as f:
-            json.dump(records, f, sort_keys=True, indent=2)
+        _dump_json_file(records, tmpfilename)
         os.rename(tmpfilename, cache_file)
 
     return records
@@ -223,12 +249,21 @@ async def produce(loop, records, queue):
     await queue.put(done)
 
 
-async def consume(loop, queue, executor, client, existing):
+async def consume(
+    loop, queue, executor, client, existing, batch_size, pending
+):
     """Store grabbed releases from the archives website in Kinto.
+
+    The futures of the submitted batches are appended to ``pending``.
     """
+    # Only pull a new batch from the queue when a publishing thread is free.
+    # Meanwhile records pile up in the queue and the next batch is fuller.
+    workers = asyncio.Semaphore(NB_THREADS, loop=loop)
+
     def markdone(queue, n):
         """Returns a callback that will mark `n` queue items done."""
         def done(future):
+            workers.release()
             [queue.task_done() for _ in range(n)]
             results = future.result()  # will raise exception if failed.
             logger.info('Pushed {} records'.format(len(results)))
@@ -236,48 +271,40 @@ async def consume(loop, queue, executor, client, existing):
         return done
 
     def record_unchanged(record):
-        return (
-            record['id'] in existing and
-            existing.get(record['id']) == hash_record(record)
-        )
-
-    info = client.server_info()
-    ideal_batch_size = min(
-        BATCH_MAX_REQUESTS,
-        info['settings']['batch_max_requests']
-    )
-
-    while 'consumer is not cancelled':
-        # Consume records from queue, and batch operations.
-        # But don't wait too much if there's not enough records
-        # to fill a batch.
-        batch = []
+        # Existing records are stored as [last_modified, hash].
         try:
-            with async_timeout.timeout(WAIT_TIMEOUT):
-                while len(batch) < ideal_batch_size:
-                    record = await queue.get()
-                    # Producer is done, don't wait for items to come in.
-                    if record is done:
-                        queue.task_done()
-                        break
-                    # Check if known and hasn't changed.
-                    if record_unchanged(record['data']):
-                        logger.debug(
-                            f"Skip unchanged record {record['id']}"
-                        )
-                        queue.task_done()
-                        continue
-
-                    # Add record to current batch, and wait for more.
-                    batch.append(record)
-
-        except asyncio.TimeoutError:
-            if batch:
+            _, existing_hash = existing[record['id']]
+        except KeyError:
+            return False
+        return existing_hash == hash_record(record)
+
+    producer_done = False
+    while not producer_done:
+        await workers.acquire()
+        # Wait for a first record, then batch those that are already
+        # in the queue, without waiting for more to come in.
+        batch = []
+        record = await queue.get()
+        while 'batch is not full':
+            # Producer is done, publish the last batch and stop.
+            if record is done:
+                queue.task_done()
+                producer_done = True
+                break
+            # Check if known and hasn't changed.
+            if record_unchanged(record['data']):
                 logger.debug(
-                    f'Stop waiting, proceed with {len(batch)} records.'
+                    f"Skip unchanged record {record['data']['id']}"
                 )
+                queue.task_done()
             else:
-                logger.debug('Waiting for records in the queue.')
+                batch.append(record)
+            if len(batch) >= batch_size:
+                break
+            try:
+                record = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
 
         # We have a batch of records, let's publish them using
         # parallel workers.
@@ -287,11 +314,18 @@ async def consume(loop, queue, executor, client, existing):
                 executor, publish_records, client, batch
             )
             task.add_done_callback(markdone(queue, len(batch)))
+            pending.append(task)
+        else:
+            workers.release()
 
 
 async def parse_json(lines):
     async for line in lines:
-        record = json.loads(line.decode('utf-8'))
+        if orjson is not None:
+            # Decodes bytes directly, without an intermediate str.
+            record = orjson.loads(line)
+        else:
+            record = json.loads(line.decode('utf-8'))
         yield record
 
 
@@ -308,18 +342,34 @@ async def main(
         # and haven't changed.
         existing = fetch_existing(client)
 
+    info = client.server_info()
+    ideal_batch_size = min(
+        BATCH_MAX_REQUESTS,
+        info['settings']['batch_max_requests']
+    )
+
     # Start a producer and a consumer with threaded kinto requests.
-    queue = asyncio.Queue()
+    # The queue is bounded so that the producer waits for the consumer
+    # instead of loading all the records in memory.
+    queue = asyncio.Queue(maxsize=ideal_batch_size * NB_THREADS * 4)
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=NB_THREADS)
+    pending = []
     # Schedule the consumer
-    consumer_coro = consume(loop, queue, executor, client, existing)
+    consumer_coro = consume(
+        loop, queue, executor, client, existing, ideal_batch_size, pending
+    )
     consumer = asyncio.ensure_future(consumer_coro)
-    # Run the producer and wait for completion
-    await produce(loop, stdin_generator, queue)
-    # Wait until the consumer is done consuming everything.
-    await queue.join()
-    # The consumer is still awaiting for the producer, cancel it.
-    consumer.cancel()
+    try:
+        # Run the producer and wait for completion
+        await produce(loop, stdin_generator, queue)
+        # The consumer stops once it has batched the last record.
+        await consumer
+        # Wait for all the batches and raise if one of them failed.
+        await asyncio.gather(*pending)
+    finally:
+        # If the producer failed, the consumer would wait forever.
+        consumer.cancel()
+        executor.shutdown(wait=True)
 
 
 def run():
@@ -4,6 +4,7 @@
 
 import asyncio
 import datetime
+import functools
 import os.path
 import re
 
@@ -21,6 +22,21 @@ KNOWN_MIMETYPES = {
     'exe': 'application/msdos-windows',
     }
 
+# Patterns that don't depend on the product, compiled once.
+_BUILD_URL_EXCLUDE_RE = re.compile(
+    '.+(tinderbox|try-builds|partner-repacks|latest|contrib|/0\.|'
+    'experimental|namoroka|debug|sha1-installers|candidates/archived|'
+    'stylo-bindings|/1.0rc/|/releases/win../|dominspector|/test/|testing|'
+    '%28.+%29|\sInstaller\.(\w{2,3}\-?\w{0,3})\.exe)'
+)
+_BUILD_FILENAME_EXCLUDE_RE = re.compile(
+    '.+(sdk|tests|crashreporter|stub|gtk2.+xft|source|asan)'
+)
+_NIGHTLY_METADATA_EXCLUDE_RE = re.compile(
+    '.+(latest-mozilla-central|test_packages|mozinfo)'
+)
+_RC_VERSION_RE = re.compile('/candidates/(.+)-candidates')
+
 
 def archive_url(
     product,
@@ -140,6 +156,13 @@ def build_record_id(record):
     return id_.replace('.', '-').lower()
 
 
+@functools.lru_cache(maxsize=None)
+def _build_filename_re(product, windows):
+    # Only .exe for Windows.
+    extensions = [e for e in FILE_EXTENSIONS if not (windows and e == 'zip')]
+    return re.compile(r'{}-(.+)\.({})$'.format(product, '|'.join(extensions)))
+
+
 def is_build_url(product, url):
     """
     - firefox/nightly/experimental/sparc-633408-fix/
@@ -167,35 +190,19 @@ def is_build_url(product, url):
     ):
         return False
 
-    re_exclude = re.compile(
-        '.+(tinderbox|try-builds|partner-repacks|latest|contrib|/0\.|'
-        'experimental|namoroka|debug|sha1-installers|candidates/archived|'
-        'stylo-bindings|/1.0rc/|/releases/win../|dominspector|/test/|testing|'
-        '%28.+%29|\sInstaller\.(\w{2,3}\-?\w{0,3})\.exe)'
-    )
-    if re_exclude.match(url):
+    if _BUILD_URL_EXCLUDE_RE.match(url):
         return False
 
-    # Only .exe for Windows.
-    extensions = list(FILE_EXTENSIONS)
-    if 'win' in url:
-        extensions.remove('zip')
-
     if product == 'devedition':
         product = 'firefox'
     if product == 'mobile':
         product = 'fennec'
     filename = os.path.basename(url)
     match_filename = filename.replace(' ', '-').lower()
-    re_filename = re.compile(
-        '{}-(.+)({})$'.format(product, '|'.join(extensions))
-    )
-    re_exclude = re.compile(
-        '.+(sdk|tests|crashreporter|stub|gtk2.+xft|source|asan)'
-    )
+    re_filename = _build_filename_re(product, windows='win' in url)
     return (
         re_filename.match(match_filename) and
-        not re_exclude.match(match_filename)
+        not _BUILD_FILENAME_EXCLUDE_RE.match(match_filename)
     )
 
 
@@ -213,7 +220,8 @@ def is_release_build_metadata(product, version, filename):
 
 
 def is_nightly_build_metadata(product, url):
-    if 'nightly' not in url:
+    # Cheap checks first, most URLs are archives.
+    if not url.endswith('.json') or 'nightly' not in url:
         return False
     if 'nightly' in url and 'mozilla-central' not in url:
         # pub/mobile/nightly/2017/08/2017-08-01-15-03-46-date-android-api-15/...
@@ -221,8 +229,7 @@ def is_nightly_build_metadata(product, url):
     if product == 'mobile':
         product = 'fennec'
     # Exlude alias folder, and other metadata.
-    re_exclude = re.compile('.+(latest-mozilla-central|test_packages|mozinfo)')
-    if re_exclude.match(url):
+    if _NIGHTLY_METADATA_EXCLUDE_RE.match(url):
         return False
     # Note: devedition has no nightly.
     re_metadata = re.compile('.+/{}-(.*)\.(.*)\.(.*)\.json$'.format(product))
@@ -230,11 +237,13 @@ def is_nightly_build_metadata(product, url):
 
 
 def is_rc_build_metadata(product, url):
+    if not url.endswith('.json'):
+        return False
     if product == 'mobile':
         product = 'fennec'
     if product == 'devedition':
         product = 'firefox'
-    m = re.search('/candidates/(.+)-candidates', url)
+    m = _RC_VERSION_RE.search(url)
     if not m:
         return False
     version = m.group(1)
@@ -403,6 +412,19 @@ def check_record(record):
         raise ValueError(f"Suspicious version '{version}': {record}")
 
 
+def build_date(buildid):
+    """Return the build date of the specified build id (e.g. 20170512021503).
+    """
+    b = buildid[:14]
+    if len(b) == 14 and b.isdigit():
+        # Validate the values without parsing the string with strptime.
+        datetime.datetime(int(b[0:4]), int(b[4:6]), int(b[6:8]),
+                          int(b[8:10]), int(b[10:12]), int(b[12:14]))
+        return f'{b[0:4]}-{b[4:6]}-{b[6:8]}T{b[8:10]}:{b[10:12]}:{b[12:14]}Z'
+    builddate = datetime.datetime.strptime(b, '%Y%m%d%H%M%S')
+    return builddate.strftime(DATETIME_FORMAT)
+
+
 def merge_metadata(record, metadata):
     if metadata is None:
         return record
@@ -423,11 +445,9 @@ def merge_metadata(record, metadata):
     record['source']['tree'] = repository.split('hg.mozilla.org/', 1)[-1]
 
     buildid = metadata['buildid']
-    builddate = datetime.datetime.strptime(buildid[:14], '%Y%m%d%H%M%S')
-    builddate = builddate.strftime(DATETIME_FORMAT)
     record['build'] = {
         'id': buildid,
-        'date': builddate,
+        'date': build_date(buildid),
     }
     # Additional compilation stuff.
     for field in ('as', 'cc', 'cxx', 'ld', 'host_alias', 'target_alias'):
@@ -31,7 +31,7 @@ class LongResponse:
     async def __aexit__(self, *args):
         pass
 
-    async def json(self):
+    async def json(self, **kwargs):
         return await asyncio.sleep(10000)
 
 
@@ -277,6 +277,31 @@ class FetchNightlyMetadata(asynctest.TestCase):
         )
         assert received == {'buildid': '20170512'}
 
+    async def test_concurrent_fetches_share_the_request(self):
+        records = [{
+            'id': locale,
+            'download': {
+                'url': f'http://server.org/firefox.{locale}.win32.exe'
+            },
+            'target': {'channel': 'nightly', 'version': '57.0a1'},
+        } for locale in ('fr', 'it')]
+
+        async def slow_fetch_json(session, url):
+            await asyncio.sleep(0.01)
+            return {'buildid': '20170512'}
+
+        with mock.patch.object(inventory_to_records, 'fetch_json',
+                               side_effect=slow_fetch_json) as fetch_json:
+            received = await asyncio.gather(*[
+                inventory_to_records.fetch_metadata(self.session, record)
+                for record in records
+            ])
+        assert received == [{'buildid': '20170512'}] * 2
+        fetch_json.assert_called_once_with(
+            self.session,
+            'http://server.org/firefox.en-US.win32.json'
+        )
+
     async def test_returns_none_if_not_available(self):
         record = {
             'id': 'a',
@@ -293,6 +318,30 @@ class FetchNightlyMetadata(asynctest.TestCase):
             )
         assert received is None
 
+    async def test_does_not_hit_server_if_known_to_be_missing(self):
+        record = {
+            'id': 'a',
+            'download': {'url': 'http://server.org/firefox.fr.win32.exe'}
+        }
+        with aioresponses() as m:
+            m.get('http://server.org/firefox.en-US.win32.json', status=404)
+            m.get('http://server.org/firefox.en-US.win32.txt', body='')
+            received = await inventory_to_records.fetch_nightly_metadata(
+                self.session,
+                record
+            )
+        assert received is None
+
+        record['download']['url'] = record['download']['url'].replace(
+            '.fr.', '.it.'
+        )
+        # Now cached, no need to mock HTTP responses.
+        received = await inventory_to_records.fetch_nightly_metadata(
+            self.session,
+            record
+        )
+        assert received is None
+
     async def test_fetch_nightly_metadata_from_installer_url(self):
         record = {'id': 'a', 'download': {
             'url': 'http://server.org/firefox.fr.win64.installer.exe'}}
@@ -807,6 +856,83 @@ class ScanCandidates(asynctest.TestCase):
                 }
             }
 
+    async def test_scan_candidates_limits_parallel_requests(self):
+        in_flight = []
+        max_in_flight = 0
+
+        async def fake_fetch_listing(session, url):
+            nonlocal max_in_flight
+            if url.endswith('pub/firefox/candidates/'):
+                versions = [f'{i}.0-candidates/' for i in range(10)]
+                return versions, []
+            in_flight.append(url)
+            max_in_flight = max(max_in_flight, len(in_flight))
+            await asyncio.sleep(0)
+            in_flight.remove(url)
+            return ['build1/'], []
+
+        with mock.patch.object(inventory_to_records, 'fetch_listing',
+                               side_effect=fake_fetch_listing):
+            with mock.patch.object(inventory_to_records,
+                                   'NB_PARALLEL_REQUESTS', 3):
+                await inventory_to_records.scan_candidates(
+                    self.session,
+                    'firefox'
+                )
+
+        assert max_in_flight == 3
+        scanned = inventory_to_records._candidates_build_folder['firefox']
+        assert len(scanned) == 10
+
+    async def test_scan_candidates_skips_versions_without_builds(self):
+        async def fake_fetch_listing(session, url):
+            if url.endswith('pub/firefox/candidates/'):
+                return ['54.0-candidates/', '55.0-candidates/'], []
+            if url.endswith('55.0-candidates/'):
+                return [], []
+            return ['build1/', 'build2/'], []
+
+        with mock.patch.object(inventory_to_records, 'fetch_listing',
+                               side_effect=fake_fetch_listing):
+            await inventory_to_records.scan_candidates(self.session,
+                                                       'firefox')
+
+        assert inventory_to_records._candidates_build_folder == {
+            'firefox': {'54.0': 'build2/'}
+        }
+
+    async def test_fetch_metadata_raises_if_scan_candidates_fails(self):
+        calls = []
+
+        async def fake_fetch_listing(session, url):
+            calls.append(url)
+            if url.endswith('pub/firefox/candidates/'):
+                return ['54.0-candidates/', '55.0-candidates/'], []
+            if url.endswith('55.0-candidates/'):
+                raise ValueError('Invalid listing')
+            return ['build1/'], []
+
+        record = {
+            'source': {'product': 'firefox'},
+            'target': {
+                'version': '54.0',
+                'platform': 'win64',
+                'locale': 'fr-FR',
+                'channel': 'release',
+            },
+            'download': {
+                'url': ('https://archive.mozilla.org/pub/firefox/releases/'
+                        '54.0/win64/fr-FR/Firefox Setup 54.0.exe'),
+            }
+        }
+        with mock.patch.object(inventory_to_records, 'fetch_listing',
+                               side_effect=fake_fetch_listing):
+            with pytest.raises(ValueError):
+                await inventory_to_records.fetch_metadata(self.session,
+                                                          record)
+        assert 'firefox' not in inventory_to_records._candidates_build_folder
+        assert len(calls) == 3
+
 
 class CSVToRecords(asynctest.TestCase):
 
@@ -1039,6 +1165,21 @@ class CSVToRecords(asynctest.TestCase):
             }
         }
 
+    async def test_csv_to_records_full_batches_are_complete(self):
+        with mock.patch.object(inventory_to_records,
+                               'NB_PARALLEL_REQUESTS', 1):
+            output = inventory_to_records.csv_to_records(
+                self.loop,
+                self.stdin,
+                skip_incomplete=False,
+                cache_folder=self.cache_folder,
+            )
+            records = []
+            async for r in output:
+                records.append(r)
+
+        assert len(records) == 2
+
     async def test_csv_to_records_continues_on_error(self):
         with mock.patch('buildhub.utils.guess_mimetype',
                         side_effect=(ValueError, 'application/zip')):
@@ -3,6 +3,7 @@
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
 import json
+import unittest
 from unittest import mock
 
 import asynctest
@@ -50,6 +51,51 @@ def fake_sns_routed_event(key):
     }
 
 
+class FormatEventTime(unittest.TestCase):
+
+    def test_microseconds_are_dropped(self):
+        formatted = lambda_s3_event._format_event_time(
+            '2017-08-08T17:06:52.030Z'
+        )
+        assert formatted == '2017-08-08T17:06:52Z'
+
+
+class LambdaHandler(unittest.TestCase):
+
+    def setUp(self):
+        for method in ('addHandler', 'setLevel'):
+            patch = mock.patch.object(lambda_s3_event.logger, method)
+            self.addCleanup(patch.stop)
+            patch.start()
+
+    def tearDown(self):
+        loop = lambda_s3_event._loop
+        loop.run_until_complete(lambda_s3_event._session.close())
+        lambda_s3_event._session = None
+        loop.close()
+        lambda_s3_event._loop = None
+
+    def test_event_loop_is_reused_across_invocations(self):
+        event = fake_event('favicon.ico')
+        lambda_s3_event.lambda_handler(event, None)
+        loop = lambda_s3_event._loop
+
+        lambda_s3_event.lambda_handler(event, None)
+
+        assert lambda_s3_event._loop is loop
+        assert not loop.is_closed()
+
+    def test_http_session_is_reused_across_invocations(self):
+        event = fake_event('favicon.ico')
+        lambda_s3_event.lambda_handler(event, None)
+        session = lambda_s3_event._session
+
+        lambda_s3_event.lambda_handler(event, None)
+
+        assert lambda_s3_event._session is session
+        assert not session.closed
+
+
 class BaseTest(asynctest.TestCase):
 
     remote_content = {}
@@ -61,6 +107,14 @@ class BaseTest(asynctest.TestCase):
         self.addCleanup(patch.stop)
         self.mock_create_record = patch.start()
 
+        # Records are created in batch, which reads the server settings.
+        patch = mock.patch(
+            'buildhub.lambda_s3_event.kinto_http.Session.request',
+            return_value=({'settings': {'batch_max_requests': 25}}, {})
+        )
+        self.addCleanup(patch.stop)
+        patch.start()
+
         self.mockresponses = aioresponses()
         self.mockresponses.start()
         for url, payload_or_status in self.remote_content.items():
@@ -320,6 +374,106 @@ class FromArchiveFirefox(BaseTest):
             'buildhub.s3_event_records_to_create'
         )
 
+    async def test_several_event_records(self):
+        event = fake_event(
+            'pub/firefox/releases/54.0/win64/fr/Firefox Setup 54.0.exe'
+        )
+        event['Records'] += fake_event(
+            'pub/firefox/nightly/2017/08/2017-08-05-10-03-34-'
+            'mozilla-central-l10n/firefox-57.0a1.ru.win32.installer.exe'
+        )['Records']
+        await lambda_s3_event.main(self.loop, event)
+
+        assert self.mock_create_record.call_count == 2
+        incrs = self.mm.filter_records(INCR, 'buildhub.s3_event_event')
+        assert len(incrs) == 2
+
+    async def test_several_release_archives_of_same_product(self):
+        event = fake_event(
+            'pub/firefox/releases/54.0/win64/fr/Firefox Setup 54.0.exe'
+        )
+        event['Records'] += fake_event(
+            'pub/firefox/releases/54.0/linux-x86_64/de/firefox-54.0.tar.bz2'
+        )['Records']
+        # The candidates are scanned only once, but the Linux metadata
+        # is needed too.
+        linux_url = (
+            utils.ARCHIVE_URL +
+            'pub/firefox/candidates/54.0-candidates/build2/linux-x86_64/en-US/'
+        )
+        self.mockresponses.get(linux_url, payload={
+            'prefixes': [], 'files': [
+                {'name': 'firefox-54.0.tar.bz2'},
+                {'name': 'firefox-54.0.json'},
+            ]
+        })
+        win_metadata = self.remote_content[
+            'pub/firefox/candidates/54.0-candidates/build2/win64/en-US/'
+            'firefox-54.0.json'
+        ]
+        self.mockresponses.get(linux_url + 'firefox-54.0.json', payload=dict(
+            win_metadata,
+            moz_pkg_platform='linux-x86_64',
+        ))
+        await lambda_s3_event.main(self.loop, event)
+
+        created = [c[1]['data']['id']
+                   for c in self.mock_create_record.call_args_list]
+        assert sorted(created) == [
+            'firefox_54-0_linux-x86_64_de',
+            'firefox_54-0_win64_fr',
+        ]
+
+    async def test_created_records_are_counted(self):
+        event = fake_event(
+            'pub/firefox/releases/54.0/win64/fr/Firefox Setup 54.0.exe'
+        )
+        event['Records'] += fake_event(
+            'pub/firefox/nightly/2017/08/2017-08-05-10-03-34-'
+            'mozilla-central-l10n/firefox-57.0a1.ru.win32.installer.exe'
+        )['Records']
+        with mock.patch('kinto_http.batch.BatchSession.results') as results:
+            results.return_value = [
+                {'data': {'id': 'firefox_54-0_win64_fr'}},
+                {'data': {
+                    'id': 'firefox_nightly_2017-08-05-10-03-34_57-0a1_win32_ru'
+                }},
+            ]
+            with self.assertLogs(lambda_s3_event.logger, 'INFO') as logs:
+                await lambda_s3_event.main(self.loop, event)
+
+        incrs = self.mm.filter_records(
+            INCR,
+            'buildhub.s3_event_record_created'
+        )
+        assert len(incrs) == 2
+        assert 'INFO:root:Created firefox_54-0_win64_fr' in logs.output
+        assert (
+            'INFO:root:Created '
+            'firefox_nightly_2017-08-05-10-03-34_57-0a1_win32_ru'
+        ) in logs.output
+
+    async def test_existing_records_are_not_errors(self):
+        event = fake_event(
+            'pub/firefox/releases/54.0/win64/fr/Firefox Setup 54.0.exe'
+        )
+        with mock.patch('kinto_http.batch.BatchSession.results') as results:
+            results.return_value = [{'code': 412, 'details': {}}]
+            await lambda_s3_event.main(self.loop, event)
+        assert not self.mm.has_record(
+            INCR,
+            'buildhub.s3_event_record_created'
+        )
+
+    async def test_invalid_records_raise(self):
+        event = fake_event(
+            'pub/firefox/releases/54.0/win64/fr/Firefox Setup 54.0.exe'
+        )
+        with mock.patch('kinto_http.batch.BatchSession.results') as results:
+            results.return_value = [{'code': 400, 'message': 'Invalid'}]
+            with self.assertRaises(ValueError):
+                await lambda_s3_event.main(self.loop, event)
+
     async def test_from_nightly_archive(self):
         event = fake_event(
             'pub/firefox/nightly/2017/08/2017-08-05-10-03-34-'
@@ -371,6 +525,15 @@ class FromArchiveFirefox(BaseTest):
             },
             if_not_exists=True)
 
+    async def test_nightly_archive_does_not_scan_candidates(self):
+        event = fake_event(
+            'pub/firefox/nightly/2017/08/2017-08-05-10-03-34-'
+            'mozilla-central-l10n/firefox-57.0a1.ru.win32.installer.exe'
+        )
+        await lambda_s3_event.main(self.loop, event)
+
+        assert 'firefox' not in inventory_to_records._candidates_build_folder
+
     async def test_from_rc_archive(self):
         event = fake_event(
             'pub/firefox/candidates/51.0-candidates/build1/linux-x86_64-EME'
@@ -615,6 +778,31 @@ class FromRCMetadataFirefox(BaseTest):
             },
             if_not_exists=True)
 
+    async def test_results_are_paired_with_records(self):
+        event = fake_event(
+            'pub/firefox/candidates/56.0b1-candidates/build4/linux-x86_64/'
+            'en-US/firefox-56.0b1.json'
+        )
+        with mock.patch('kinto_http.batch.BatchSession.results') as results:
+            results.return_value = [
+                {'code': 412, 'details': {}},
+                {'data': {}},
+            ]
+            with self.assertLogs(lambda_s3_event.logger, 'INFO') as logs:
+                await lambda_s3_event.main(self.loop, event)
+
+        existing, created = [
+            kwargs['data']['id']
+            for _, kwargs in self.mock_create_record.call_args_list
+        ]
+        assert f'INFO:root:Exists {existing}' in logs.output
+        assert f'INFO:root:Created {created}' in logs.output
+        incrs = self.mm.filter_records(
+            INCR,
+            'buildhub.s3_event_record_created'
+        )
+        assert len(incrs) == 1
+
 
 class FromNightlyArchiveFirefox(BaseTest):
     remote_content = {
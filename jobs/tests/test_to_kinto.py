@@ -2,15 +2,18 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, you can obtain one at http://mozilla.org/MPL/2.0/.
 
+import asyncio
 import json
 import os
 import unittest
+from unittest import mock
 # Because you can't just import unittest and access 'unittest.mock.MagicMock'
 from unittest.mock import MagicMock
 
+import asynctest
 import pytest
 
-from buildhub.to_kinto import fetch_existing
+from buildhub.to_kinto import fetch_existing, hash_record, main, parse_json
 
 
 class CacheValueTest(unittest.TestCase):
@@ -46,6 +49,30 @@ class CacheValueTest(unittest.TestCase):
         second_hash = second['a'][1]
         assert first_hash != second_hash
 
+    def test_cache_file_is_not_rewritten_without_new_records(self):
+        mocked = MagicMock()
+        mocked.session.server_url = 'http://localhost:8888/v1'
+        mocked.get_records.return_value = [
+            {'id': 'a', 'title': 'a', 'last_modified': 1}
+        ]
+        first = fetch_existing(mocked, cache_file=self.cache_file)
+        os.utime(self.cache_file, (0, 0))
+
+        mocked.get_records.return_value = []
+        second = fetch_existing(mocked, cache_file=self.cache_file)
+        assert second == first
+        assert os.stat(self.cache_file).st_mtime == 0
+        mocked.get_records.assert_called_with(_since='"1"', pages=float('inf'))
+
+    def test_empty_cache_file_fetches_everything(self):
+        with open(self.cache_file, 'w') as f:
+            json.dump({}, f)
+        mocked = MagicMock()
+        mocked.session.server_url = 'http://localhost:8888/v1'
+        mocked.get_records.return_value = []
+        assert fetch_existing(mocked, cache_file=self.cache_file) == {}
+        mocked.get_records.assert_called_with(_since=None, pages=float('inf'))
+
     def test_dump_file_cache_migration(self):
         # Make sure the new cache file doesn't exist
         if os.path.exists(self.cache_file):
@@ -90,3 +117,101 @@ class CacheValueTest(unittest.TestCase):
         with open(self.cache_file) as f:
             records = json.load(f)
             assert len(records) == 2
+
+
+class MainTest(asynctest.TestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.server_info.return_value = {
+            'settings': {'batch_max_requests': 2}
+        }
+        self.batch = self.client.batch.return_value.__enter__.return_value
+
+    async def records(self, count):
+        for i in range(count):
+            yield {'data': {'id': str(i), 'title': str(i)}}
+
+    async def test_all_records_are_published(self):
+        # More records than the queue can hold (2 * NB_THREADS * 4).
+        await main(
+            self.loop,
+            self.records(100),
+            self.client,
+            skip_existing=False
+        )
+        assert self.batch.update_record.call_count == 100
+
+    async def test_records_are_published_without_waiting_for_a_full_batch(
+        self
+    ):
+        published = asyncio.Event(loop=self.loop)
+
+        def batch():
+            self.loop.call_soon_threadsafe(published.set)
+            return mock.DEFAULT
+
+        self.client.batch.side_effect = batch
+
+        async def records():
+            yield {'data': {'id': '0', 'title': '0'}}
+            # The first record is published even if the batch is not full.
+            await asyncio.wait_for(published.wait(), 1, loop=self.loop)
+            yield {'data': {'id': '1', 'title': '1'}}
+
+        await main(self.loop, records(), self.client, skip_existing=False)
+        assert self.batch.update_record.call_count == 2
+
+    async def test_invalid_records_stop_the_consumer(self):
+        async def records():
+            yield {'title': 'a'}
+
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(
+                main(self.loop, records(), self.client, skip_existing=False),
+                1,
+                loop=self.loop
+            )
+
+    async def test_publication_errors_are_raised(self):
+        self.batch.results.return_value = [{'code': 400}]
+        with pytest.raises(ValueError):
+            await main(
+                self.loop,
+                self.records(1),
+                self.client,
+                skip_existing=False
+            )
+
+    async def test_unchanged_records_are_skipped(self):
+        existing = {
+            '1': [42, hash_record({'id': '1', 'title': '1'})],
+            '2': [43, hash_record({'id': '2', 'title': 'changed'})],
+        }
+        await main(
+            self.loop,
+            self.records(3),
+            self.client,
+            skip_existing=False,
+            existing=existing
+        )
+        published = [
+            c[1]['data']['id']
+            for c in self.batch.update_record.call_args_list
+        ]
+        assert sorted(published) == ['0', '2']
+
+
+class ParseJsonTest(asynctest.TestCase):
+
+    async def test_lines_are_decoded_from_bytes(self):
+        async def lines():
+            yield b'{"data": {"title": "\xc3\xa9t\xc3\xa9"}}\n'
+            yield b'{"data": {"id": "a", "size": 42}}\n'
+
+        records = [r async for r in parse_json(lines())]
+
+        assert records == [
+            {'data': {'title': 'été'}},
+            {'data': {'id': 'a', 'size': 42}},
+        ]
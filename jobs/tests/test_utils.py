@@ -17,6 +17,7 @@ from buildhub.utils import (
     localize_release_candidate_url,
     record_from_url,
     merge_metadata,
+    build_date,
     check_record,
     is_rc_build_metadata,
     is_nightly_build_metadata
@@ -1053,6 +1054,11 @@ WRONG_RELEASE_FILENAMES = [
         'pub/firefox/candidates/55.0b9-candidates/build2/win64/zh-TW/firefox'
         '-55.0b9.zip'
     ),
+    # Extension without a dot.
+    (
+        'firefox',
+        'pub/firefox/releases/55.0/linux-x86_64/en-US/firefox-55.0.tar.gzip'
+    ),
 ]
 
 
@@ -1267,6 +1273,24 @@ def test_merge_metadata(record, metadata, expected):
     assert result == expected
 
 
+BUILD_DATES = (
+    ('20170512021503', '2017-05-12T02:15:03Z'),
+    ('20170512021503123', '2017-05-12T02:15:03Z'),
+    # Short build ids are parsed leniently.
+    ('201706121152', '2017-06-12T11:05:02Z'),
+)
+
+
+@pytest.mark.parametrize('buildid,expected', BUILD_DATES)
+def test_build_date(buildid, expected):
+    assert build_date(buildid) == expected
+
+
+def test_build_date_invalid():
+    with pytest.raises(ValueError):
+        build_date('20171312021503')
+
+
 NORMALIZED_PLATFORMS = (
     ('android', 'android'),
     ('android', 'android-aarch64'),